@@ -1,83 +1,439 @@
+import io
 import os
 import re
+import uuid
+import shlex
+import codecs
+import queue
+import tarfile
+import collections
+import atexit
+import asyncio
+import inspect
 import logging
+import threading
+import concurrent.futures
 import docker
 
 IMAGE_NAME = "joshxt/safeexecute:latest"
+PIP_INSTALL_PATTERN = re.compile(r"pip install (.*)")
+# Number of idle containers kept warm per mounted working directory, 0 disables reuse
+POOL_SIZE = max(0, int(os.environ.get("SAFEEXECUTE_POOL_SIZE", 2)))
+# Label on every container started here, so orphaned ones can be found and removed
+CONTAINER_LABEL = "safeexecute"
+# Number of working directories that keep a pool before the least recent is closed
+MAX_POOLS = max(1, int(os.environ.get("SAFEEXECUTE_MAX_POOLS", 16)))
+# Packages baked into the image never need a pip install. The standard library is
+# read from the container, as its Python version can differ from the host's.
+PREINSTALLED_PACKAGES = frozenset(
+    [
+        "numpy",
+        "matplotlib",
+        "seaborn",
+        "scikit-learn",
+        "yfinance",
+        "scipy",
+        "statsmodels",
+        "sympy",
+        "bokeh",
+        "plotly",
+        "dash",
+        "networkx",
+        "pyvis",
+        "pandas",
+        "pip",
+    ]
+)
+REQUIREMENT_NAME_PATTERN = re.compile(r"[<>=!~\[;@]")
+# Optional host directory shared with every container as pip's cache
+PIP_CACHE_DIRECTORY = os.environ.get("SAFEEXECUTE_PIP_CACHE")
+# Prints every standard library module and installed distribution in the image
+IMAGE_PACKAGES_SCRIPT = (
+    "import sys, importlib.metadata as m; "
+    "print(*sys.stdlib_module_names, *(d.metadata['Name'] for d in m.distributions()))"
+)
+
+_image_packages = None
+_docker_client = None
+_docker_client_lock = threading.Lock()
+_container_pools = collections.OrderedDict()
+_container_pools_lock = threading.Lock()
+# Removing a container is a blocking daemon call, so it is kept off the caller's path
+_cleanup_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=4, thread_name_prefix="safeexecute-cleanup"
+)
 
 
 def install_docker_image():
-    client = docker.from_env()
-    try:
-        client.images.get(IMAGE_NAME)
-        logging.info(f"Image '{IMAGE_NAME}' found locally")
-    except:
-        logging.info(f"Installing docker image '{IMAGE_NAME}' from Docker Hub")
-        client.images.pull(IMAGE_NAME)
-        logging.info(f"Image '{IMAGE_NAME}' installed")
+    global _docker_client
+    # The image only needs to be checked once per process
+    if _docker_client is not None:
+        return _docker_client
+    with _docker_client_lock:
+        if _docker_client is not None:
+            return _docker_client
+        client = docker.from_env()
+        try:
+            client.images.get(IMAGE_NAME)
+            logging.info(f"Image '{IMAGE_NAME}' found locally")
+        except:
+            logging.info(f"Installing docker image '{IMAGE_NAME}' from Docker Hub")
+            client.images.pull(IMAGE_NAME)
+            logging.info(f"Image '{IMAGE_NAME}' installed")
+        _docker_client = client
     return client
 
 
-def execute_python_code(code: str, working_directory: str = None) -> str:
+def _get_container_pool(docker_working_dir: str) -> queue.Queue:
+    evicted = []
+    with _container_pools_lock:
+        pool = _container_pools.get(docker_working_dir)
+        if pool is None:
+            pool = queue.Queue(maxsize=POOL_SIZE)
+            _container_pools[docker_working_dir] = pool
+            while len(_container_pools) > MAX_POOLS:
+                evicted.append(_container_pools.popitem(last=False)[1])
+        else:
+            _container_pools.move_to_end(docker_working_dir)
+    for evicted_pool in evicted:
+        _drain_container_pool(evicted_pool, _discard_container)
+    return pool
+
+
+def _drain_container_pool(pool: queue.Queue, remove):
+    while True:
+        try:
+            container = pool.get_nowait()
+        except queue.Empty:
+            break
+        remove(container)
+
+
+def _remove_container(container):
+    try:
+        container.remove(force=True)
+    except Exception as e:
+        logging.warning(f"Error removing container '{container.id}': {str(e)}")
+
+
+def _discard_container(container):
+    try:
+        _cleanup_executor.submit(_remove_container, container)
+    except RuntimeError:
+        # The executor is already shut down during interpreter exit
+        _remove_container(container)
+
+
+def _acquire_container(client, docker_working_dir: str):
+    # Reuse an idle container for this working directory if one is still running
+    pool = _get_container_pool(docker_working_dir)
+    while True:
+        try:
+            container = pool.get_nowait()
+        except queue.Empty:
+            break
+        try:
+            container.reload()
+            if container.status == "running":
+                return container
+        except Exception as e:
+            logging.warning(f"Pooled container is no longer usable: {str(e)}")
+        _discard_container(container)
+    return _start_container(client, docker_working_dir)
+
+
+def _start_container(client, docker_working_dir: str):
+    volumes = {
+        docker_working_dir: {
+            "bind": "/workspace",
+            "mode": "rw",
+        }
+    }
+    # Paths from inside another container do not exist on the Docker host
+    if PIP_CACHE_DIRECTORY and not os.environ.get("DOCKER_CONTAINER", False):
+        os.makedirs(PIP_CACHE_DIRECTORY, exist_ok=True)
+        volumes[os.path.abspath(PIP_CACHE_DIRECTORY)] = {
+            "bind": "/root/.cache/pip",
+            "mode": "rw",
+        }
+    logging.info(f"Starting a new '{IMAGE_NAME}' container")
+    # containers.run pulls the image itself if it was removed after being checked
+    return client.containers.run(
+        IMAGE_NAME,
+        ["sleep", "infinity"],
+        volumes=volumes,
+        working_dir="/workspace",
+        detach=True,
+        labels={CONTAINER_LABEL: "pool"},
+    )
+
+
+def prewarm_containers(working_directory: str = None, count: int = None) -> int:
+    # Start idle containers ahead of time so the first executions skip the cold start
     if working_directory is None:
         working_directory = os.path.join(os.getcwd(), "WORKSPACE")
+    docker_working_dir = _docker_working_directory(working_directory)
+    os.makedirs(working_directory, exist_ok=True)
+    count = POOL_SIZE if count is None else min(count, POOL_SIZE)
+    started = 0
+    try:
+        client = install_docker_image()
+        missing = count - _get_container_pool(docker_working_dir).qsize()
+        # The pool is fetched again for every put, since another thread may evict
+        # it while a container is starting
+        for _ in range(missing):
+            container = _start_container(client, docker_working_dir)
+            try:
+                _get_container_pool(docker_working_dir).put_nowait(container)
+            except queue.Full:
+                _discard_container(container)
+                break
+            started += 1
+    except Exception as e:
+        logging.error(f"Error prewarming containers: {str(e)}")
+    return started
+
+
+def _copy_to_container(container, directory: str, files: dict):
+    # Send every file in one tar archive so it costs a single API call
+    archive = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode="w") as tar:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mode = 0o644
+            tar.addfile(info, io.BytesIO(data))
+    container.put_archive(directory, archive.getvalue())
+
+
+def _get_image_packages(client) -> frozenset:
+    global _image_packages
+    # Probed once per process in a throwaway container, as a pooled one can carry
+    # packages installed by earlier runs that a fresh container would not have
+    if _image_packages is not None:
+        return _image_packages
+    try:
+        output = client.containers.run(
+            IMAGE_NAME,
+            ["python", "-c", IMAGE_PACKAGES_SCRIPT],
+            remove=True,
+            labels={CONTAINER_LABEL: "probe"},
+        )
+    except Exception as e:
+        logging.warning(
+            f"Could not list the packages installed in '{IMAGE_NAME}': {str(e)}"
+        )
+        return PREINSTALLED_PACKAGES
+    _image_packages = PREINSTALLED_PACKAGES | frozenset(
+        _package_name(name) for name in output.decode("utf-8", errors="replace").split()
+    )
+    return _image_packages
+
+
+def _pip_install(container, requirement: str) -> bool:
+    try:
+        arguments = shlex.split(requirement)
+    except ValueError:
+        # Prose around a pip install line can contain unbalanced quotes
+        arguments = requirement.split()
+    try:
+        logging.info(f"Installing package '{requirement}' in container")
+        result = container.exec_run(
+            ["pip", "install", *arguments], workdir="/workspace"
+        )
+    except Exception as e:
+        logging.error(f"Error installing package '{requirement}': {str(e)}")
+        raise
+    # A failed install is reported but the code still runs, as it may not
+    # actually need the package
+    if result.exit_code != 0:
+        output = result.output.decode("utf-8", errors="replace")
+        logging.warning(
+            f"pip exited with code {result.exit_code} installing '{requirement}': "
+            f"{output}"
+        )
+        return False
+    return True
+
+
+def _install_packages(client, container, package_requirements: list):
+    if not package_requirements:
+        return
+    package_requirements = list(dict.fromkeys(package_requirements))
+    installed_packages = _get_image_packages(client)
+    for requirement in _filter_package_requirements(
+        package_requirements, installed_packages
+    ):
+        if _pip_install(container, requirement) or _has_pip_options(requirement):
+            continue
+        # One bad token fails the whole merged run, so install each original line
+        # on its own to get everything that can be installed
+        plain_requirements = [
+            requirement
+            for requirement in package_requirements
+            if not _has_pip_options(requirement)
+        ]
+        if len(plain_requirements) > 1:
+            logging.info("Installing each pip install line separately")
+            for plain_requirement in plain_requirements:
+                for line_requirement in _filter_package_requirements(
+                    [plain_requirement], installed_packages
+                ):
+                    _pip_install(container, line_requirement)
+
+
+def _prepare_container(
+    client, docker_working_dir: str, package_requirements: list, scripts: dict
+):
+    # A pooled container can die between being checked and being used, so a
+    # failed preparation or start of the first script is retried once on a fresh
+    # container. Only the start is retried, the script's output is streamed later.
+    for attempt in range(2):
+        container = _acquire_container(client, docker_working_dir)
+        try:
+            _install_packages(client, container, package_requirements)
+            # Scripts live in the container's /tmp so the user's workspace is untouched
+            _copy_to_container(container, "/tmp", scripts)
+            result = _exec_script(container, next(iter(scripts)), stream=True)
+            return container, result
+        except docker.errors.APIError as e:
+            _discard_container(container)
+            if attempt:
+                raise
+            logging.warning(f"Retrying in a new container: {str(e)}")
+        except BaseException:
+            _discard_container(container)
+            raise
+
+
+def _exec_script(container, script_name: str, stream: bool = False):
+    # Run the script and remove it in the same exec to avoid another round trip.
+    # The script sits in /tmp, so PYTHONPATH keeps modules in the workspace
+    # importable as they were when it ran from /workspace.
+    return container.exec_run(
+        [
+            "sh",
+            "-c",
+            'python "$0"; status=$?; rm -f "$0"; exit $status',
+            f"/tmp/{script_name}",
+        ],
+        workdir="/workspace",
+        environment={"PYTHONPATH": "/workspace"},
+        stream=stream,
+    )
+
+
+def _release_container(container, docker_working_dir: str):
+    if POOL_SIZE < 1:
+        _discard_container(container)
+        return
+    try:
+        _get_container_pool(docker_working_dir).put_nowait(container)
+    except queue.Full:
+        _discard_container(container)
+
+
+def _docker_working_directory(working_directory: str) -> str:
+    # Running inside a container, the mount source must be the Docker host's path.
+    # Not cached, as abspath depends on the current directory at call time.
     docker_working_dir = working_directory
     if os.environ.get("DOCKER_CONTAINER", False):
         docker_working_dir = os.environ.get("WORKING_DIRECTORY", working_directory)
-    if not os.path.exists(working_directory):
-        os.makedirs(working_directory)
+    return os.path.abspath(docker_working_dir)
+
+
+def _package_name(requirement: str) -> str:
+    name = REQUIREMENT_NAME_PATTERN.split(requirement, 1)[0]
+    return name.lower().replace("_", "-")
+
+
+def _has_pip_options(requirement: str) -> bool:
+    return any(package.startswith("-") for package in requirement.split())
+
+
+def _filter_package_requirements(
+    package_requirements: list, installed_packages: frozenset = PREINSTALLED_PACKAGES
+) -> list:
+    # Drop packages that are already available in the container and merge the
+    # rest into a single requirement so pip only has to run once
+    filtered = []
+    packages = []
+    for requirement in package_requirements:
+        if _has_pip_options(requirement):
+            # Leave lines with pip options such as -r or -U untouched
+            filtered.append(requirement)
+            continue
+        for package in requirement.split():
+            name = _package_name(package)
+            # Only bare names are skipped, version pins and extras still go to pip
+            if name == package.lower().replace("_", "-") and name in installed_packages:
+                continue
+            if package not in packages:
+                packages.append(package)
+    if packages:
+        filtered.insert(0, " ".join(packages))
+    return filtered
+
+
+def _parse_code(code: str) -> tuple:
     # Check if there are any package requirements in the code to install
-    package_requirements = re.findall(r"pip install (.*)", code)
-    # Strip out python code blocks if they exist in the code
-    if "```python" in code:
-        code = code.split("```python")[1].split("```")[0]
-    temp_file = os.path.join(working_directory, "temp.py")
-    with open(temp_file, "w") as f:
-        f.write(code)
-    os.chmod(temp_file, 0o755)  # Set executable permissions
+    package_requirements = []
+    if "pip install" in code:
+        package_requirements = PIP_INSTALL_PATTERN.findall(code)
+    # Strip out the first python code block if there is one
+    start = code.find("```python")
+    if start != -1:
+        code = code[start + len("```python") :].partition("```")[0]
+    return code, package_requirements
+
+
+@atexit.register
+def shutdown_container_pools():
+    with _container_pools_lock:
+        pools = list(_container_pools.values())
+        _container_pools.clear()
+    for pool in pools:
+        _drain_container_pool(pool, _remove_container)
+    _cleanup_executor.shutdown(wait=True)
+
+
+def execute_python_code(
+    code: str, working_directory: str = None, stream_callback=None
+) -> str:
+    if working_directory is None:
+        working_directory = os.path.join(os.getcwd(), "WORKSPACE")
+    docker_working_dir = _docker_working_directory(working_directory)
+    os.makedirs(working_directory, exist_ok=True)
+    code, package_requirements = _parse_code(code)
+    script_name = f"safeexecute_{uuid.uuid4().hex}.py"
     try:
         client = install_docker_image()
-        if package_requirements:
-            # Install the required packages in the container
-            for package in package_requirements:
-                try:
-                    logging.info(f"Installing package '{package}' in container")
-                    client.containers.run(
-                        IMAGE_NAME,
-                        f"pip install {package}",
-                        volumes={
-                            os.path.abspath(docker_working_dir): {
-                                "bind": "/workspace",
-                                "mode": "rw",
-                            }
-                        },
-                        working_dir="/workspace",
-                        stderr=True,
-                        stdout=True,
-                        detach=True,
-                    )
-                except Exception as e:
-                    logging.error(f"Error installing package '{package}': {str(e)}")
-                    return f"Error: {str(e)}"
-        # Run the Python code in the container
-        container = client.containers.run(
-            IMAGE_NAME,
-            f"python /workspace/temp.py",
-            volumes={
-                os.path.abspath(docker_working_dir): {
-                    "bind": "/workspace",
-                    "mode": "rw",
-                }
-            },
-            working_dir="/workspace",
-            stderr=True,
-            stdout=True,
-            detach=True,
+        container, result = _prepare_container(
+            client,
+            docker_working_dir,
+            package_requirements,
+            {script_name: code.encode("utf-8")},
         )
-        container.wait()
-        logs = container.logs().decode("utf-8")
-        container.remove()
-        os.remove(temp_file)
+        try:
+            # Collect the output as it arrives, decoding incrementally for the
+            # callback so characters split across chunks are not mangled
+            output = []
+            decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+            for chunk in result.output:
+                output.append(chunk)
+                if stream_callback is not None:
+                    text = decoder.decode(chunk)
+                    if text:
+                        stream_callback(text)
+            if stream_callback is not None:
+                text = decoder.decode(b"", final=True)
+                if text:
+                    stream_callback(text)
+        except BaseException:
+            _discard_container(container)
+            raise
+        _release_container(container, docker_working_dir)
+        logs = b"".join(output).decode("utf-8", errors="replace")
         logging.info(f"Python code executed successfully. Logs: {logs}")
         return logs
     except Exception as e:
@@ -85,5 +441,65 @@ def execute_python_code(code: str, working_directory: str = None) -> str:
         return f"Error: {str(e)}"
 
 
+def execute_python_code_many(snippets: list, working_directory: str = None) -> list:
+    if working_directory is None:
+        working_directory = os.path.join(os.getcwd(), "WORKSPACE")
+    if not snippets:
+        return []
+    docker_working_dir = _docker_working_directory(working_directory)
+    os.makedirs(working_directory, exist_ok=True)
+    # Install the requirements of every snippet together before running any of them
+    scripts = {}
+    package_requirements = []
+    for snippet in snippets:
+        code, requirements = _parse_code(snippet)
+        scripts[f"safeexecute_{uuid.uuid4().hex}.py"] = code.encode("utf-8")
+        package_requirements.extend(requirements)
+    results = []
+    try:
+        client = install_docker_image()
+        container, result = _prepare_container(
+            client, docker_working_dir, package_requirements, scripts
+        )
+        try:
+            # The first script was already started while preparing the container
+            output = b"".join(result.output)
+            results.append(output.decode("utf-8", errors="replace"))
+            for script_name in list(scripts)[1:]:
+                output = _exec_script(container, script_name).output
+                results.append(output.decode("utf-8", errors="replace"))
+        except BaseException:
+            _discard_container(container)
+            raise
+        _release_container(container, docker_working_dir)
+        logging.info(f"Executed {len(results)} Python snippets successfully")
+        return results
+    except Exception as e:
+        logging.error(f"Error executing Python code: {str(e)}")
+        # Snippets that already ran keep their output, only the rest get the error
+        return results + [f"Error: {str(e)}"] * (len(snippets) - len(results))
+
+
+async def aexecute_python_code(
+    code: str, working_directory: str = None, stream_callback=None
+) -> str:
+    # Docker calls block, so run them in a worker thread to keep the event loop free
+    callback = stream_callback
+    if callback is not None:
+        loop = asyncio.get_running_loop()
+
+        # Output arrives on the worker thread, so hand each chunk to the event loop.
+        # A coroutine callback is awaited before reading on to keep chunks in order.
+        def stream_callback(text):
+            if inspect.iscoroutinefunction(callback):
+                asyncio.run_coroutine_threadsafe(callback(text), loop).result()
+            else:
+                loop.call_soon_threadsafe(callback, text)
+
+    return await asyncio.to_thread(
+        execute_python_code, code, working_directory, stream_callback
+    )
+
+
 if __name__ == "__main__":
     install_docker_image()